@@ -1,12 +1,15 @@
+import aiosqlite
+import asyncio
 import requests
-from bs4 import BeautifulSoup
-import sqlite3
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
 import time
 import logging
 import os
 from datetime import datetime
-from telegram import Bot, Update
-from telegram.ext import Application, CommandHandler, ContextTypes
+from urllib.parse import urljoin
+from telegram import Bot, InputMediaPhoto, Update
+from telegram.ext import AIORateLimiter, Application, CommandHandler, ContextTypes
 
 # ====== НАСТРОЙКИ ======
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -14,8 +17,26 @@ TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
 URL_TO_MONITOR = "https://www.kino-teatr.ru/mourn/y2025/m12/"
 CHECK_INTERVAL = 300  # 5 минут в секундах
 DATABASE_FILE = "profiles.db"
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+REQUEST_TIMEOUT = 10  # секунды
+MEDIA_GROUP_SIZE = 10  # максимум фото в одном альбоме Telegram
+SEND_CONCURRENCY = 3  # одновременных запросов в наш чат; темп отправки ограничивает AIORateLimiter
+SEND_MAX_RETRIES = 3  # повторов после ответа Telegram RetryAfter (429)
+PHOTO_CHECK_TIMEOUT = 3  # секунды на HEAD-запрос к фото
+HTTP_POOL_SIZE = 10  # keep-alive соединений к одному хосту; столько же HEAD-запросов к фото одновременно
+MAX_PHOTO_SIZE = 5 * 1024 * 1024  # Telegram не загружает фото по ссылке больше 5 МБ
 # =======================
 
+# CSS-селекторы для разбора страницы; нужно адаптировать под конкретную структуру
+PROFILE_BLOCK_SELECTOR = 'div.actor-item, div.person-item'
+FALLBACK_BLOCK_SELECTOR = 'div[class*=item], div[class*=card]'
+NAME_SELECTOR = (
+    'h3[class*=name], h4[class*=name], div[class*=name], '
+    'h3[class*=title], h4[class*=title], div[class*=title]'
+)
+# Ссылка, фото и имя блока одним проходом вместо трех отдельных поисков
+BLOCK_PARTS_SELECTOR = f'a, img, {NAME_SELECTOR}'
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -23,168 +44,323 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def create_session():
+    """Создает HTTP-сессию с пулом соединений, чтобы не повторять TCP/TLS рукопожатие при каждой проверке"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'User-Agent': USER_AGENT})
+    return session
+
+async def open_database():
+    """Открывает долгоживущее соединение с базой данных; запросы выполняются в отдельном потоке aiosqlite"""
+    db = await aiosqlite.connect(DATABASE_FILE, isolation_level=None)
+    # WAL сохраняется в файле базы, остальные настройки действуют только для этого соединения
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA cache_size=-8000")
+    return db
+
+# id без AUTOINCREMENT: обычный rowid не требует ведения sqlite_sequence при каждой вставке
+PROFILES_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY,
+        profile_url TEXT UNIQUE,
+        name TEXT,
+        photo_url TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
 class ProfileMonitor:
     def __init__(self):
-        self.init_database()
+        self.session = create_session()
+        # Соединение открывается в init_database, уже внутри цикла событий бота
+        self.db = None
+        # Валидаторы последнего ответа для условного GET
+        self.last_etag = None
+        self.last_modified = None
+        self.seen_urls = set()
     
-    def init_database(self):
+    @property
+    def profile_count(self):
+        """Количество профилей в базе: в кэше лежат ровно все сохраненные ссылки"""
+        return len(self.seen_urls)
+    
+    async def init_database(self):
         """Инициализация базы данных для хранения отслеживаемых профилей"""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tracked_profiles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                profile_url TEXT UNIQUE,
-                name TEXT,
-                photo_url TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        conn.commit()
-        conn.close()
+        self.db = await open_database()
+        rows = await self.db.execute_fetchall(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'tracked_profiles'"
+        )
+        if rows and 'AUTOINCREMENT' in rows[0][0].upper():
+            await self.migrate_from_autoincrement()
+        else:
+            await self.db.execute(PROFILES_TABLE_SQL.format(table='tracked_profiles'))
+        self.seen_urls = await self.load_seen_urls()
         logger.info("База данных инициализирована")
     
+    async def close(self):
+        """Закрывает соединение с базой данных и HTTP-сессию"""
+        if self.db is not None:
+            await self.db.close()
+        self.session.close()
+    
+    async def migrate_from_autoincrement(self):
+        """Пересоздает таблицу без AUTOINCREMENT, чтобы вставки не обновляли sqlite_sequence"""
+        await self.db.execute("BEGIN")
+        try:
+            await self.db.execute(PROFILES_TABLE_SQL.format(table='tracked_profiles_new'))
+            await self.db.execute('''
+                INSERT INTO tracked_profiles_new (id, profile_url, name, photo_url, created_at)
+                SELECT id, profile_url, name, photo_url, created_at FROM tracked_profiles
+            ''')
+            await self.db.execute("DROP TABLE tracked_profiles")
+            await self.db.execute("ALTER TABLE tracked_profiles_new RENAME TO tracked_profiles")
+            await self.db.execute("COMMIT")
+        except Exception:
+            await self.db.execute("ROLLBACK")
+            raise
+        logger.info("Таблица tracked_profiles перенесена на схему без AUTOINCREMENT")
+    
+    async def load_seen_urls(self):
+        """Загружает ссылки уже известных профилей, чтобы не обращаться к базе за каждой"""
+        rows = await self.db.execute_fetchall("SELECT profile_url FROM tracked_profiles")
+        return {row[0] for row in rows}
+    
+    async def check_database(self):
+        """Проверяет, что база данных отвечает на запросы"""
+        await self.db.execute_fetchall("SELECT 1 FROM tracked_profiles LIMIT 1")
+    
     def extract_profiles(self):
         """
-        Парсит страницу и извлекает информацию о профилях актеров
+        Парсит страницу и извлекает информацию о профилях актеров.
+        Возвращает профили и новые валидаторы (ETag, Last-Modified) или None,
+        если запоминать нечего: их применяют только после сохранения профилей
         """
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            response = requests.get(URL_TO_MONITOR, headers=headers)
+            headers = {}
+            if self.last_etag:
+                headers['If-None-Match'] = self.last_etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+            
+            response = self.session.get(URL_TO_MONITOR, headers=headers, timeout=REQUEST_TIMEOUT)
+            if response.status_code == 304:
+                logger.info("Страница не изменилась с прошлой проверки")
+                return [], None
             response.raise_for_status()
+            validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
             
-            soup = BeautifulSoup(response.text, 'html.parser')
-            profiles = []
+            tree = LexborHTMLParser(response.content)
+            # Относительные ссылки разрешаем от адреса самой страницы (с учетом редиректов), как браузер
+            page_url = response.url
+            # Профили по ссылке: один человек может попасть в несколько блоков страницы
+            profiles = {}
             
             # Ищем контейнеры с профилями актеров
-            # Нужно адаптировать селекторы под конкретную структуру страницы
-            profile_blocks = soup.find_all('div', class_=['actor-item', 'person-item'])
+            profile_blocks = tree.css(PROFILE_BLOCK_SELECTOR)
             
             if not profile_blocks:
                 # Альтернативный поиск - ищем любые карточки с фото и ссылками
-                profile_blocks = soup.find_all('div', class_=lambda x: x and ('item' in x or 'card' in x))
+                profile_blocks = tree.css(FALLBACK_BLOCK_SELECTOR)
             
             for block in profile_blocks:
                 try:
+                    link_tag = img_tag = name_tag = None
+                    for node in block.css(BLOCK_PARTS_SELECTOR):
+                        # css() может вернуть сам блок, а ищем мы только среди вложенных тегов
+                        if node.mem_id == block.mem_id:
+                            continue
+                        if node.tag == 'a':
+                            if link_tag is None:
+                                link_tag = node
+                        elif node.tag == 'img':
+                            if img_tag is None:
+                                img_tag = node
+                        elif name_tag is None:
+                            name_tag = node
+                        if link_tag is not None and img_tag is not None and name_tag is not None:
+                            break
+                    
                     # Извлекаем ссылку на профиль
-                    link_tag = block.find('a')
-                    if not link_tag or not link_tag.get('href'):
+                    if not link_tag or not link_tag.attributes.get('href'):
                         continue
                     
-                    profile_url = link_tag['href']
-                    if not profile_url.startswith('http'):
-                        profile_url = 'https://www.kino-teatr.ru' + profile_url
+                    profile_url = urljoin(page_url, link_tag.attributes['href'])
+                    if profile_url in profiles:
+                        continue
                     
                     # Извлекаем имя
-                    name_tag = block.find(['h3', 'h4', 'div'], class_=lambda x: x and ('name' in x or 'title' in x))
-                    name = name_tag.get_text().strip() if name_tag else "Неизвестно"
+                    name = name_tag.text().strip() if name_tag else "Неизвестно"
                     
                     # Извлекаем фото
-                    img_tag = block.find('img')
-                    photo_url = img_tag['src'] if img_tag and img_tag.get('src') else None
-                    if photo_url and not photo_url.startswith('http'):
-                        photo_url = 'https://www.kino-teatr.ru' + photo_url
+                    photo_src = img_tag.attributes.get('src') if img_tag else None
+                    photo_url = urljoin(page_url, photo_src) if photo_src else None
                     
-                    profiles.append({
+                    profiles[profile_url] = {
                         'url': profile_url,
                         'name': name,
                         'photo': photo_url
-                    })
+                    }
                     
                 except Exception as e:
                     logger.warning(f"Ошибка при парсинге блока профиля: {e}")
                     continue
             
             logger.info(f"Найдено профилей на странице: {len(profiles)}")
-            return profiles
+            return list(profiles.values()), validators
             
         except Exception as e:
             logger.error(f"Ошибка при парсинге страницы: {e}")
-            return []
+            return [], None
     
-    def save_profile(self, profile):
-        """Сохраняет профиль в базу данных если его еще нет"""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
+    async def save_profiles(self, profiles):
+        """Сохраняет профили одной транзакцией и возвращает те, которых еще не было в базе, или None при ошибке"""
+        new_profiles = []
         
         try:
-            cursor.execute('''
-                INSERT OR IGNORE INTO tracked_profiles (profile_url, name, photo_url)
-                VALUES (?, ?, ?)
-            ''', (profile['url'], profile['name'], profile['photo']))
+            await self.db.execute("BEGIN")
+            for profile in profiles:
+                async with self.db.execute('''
+                    INSERT INTO tracked_profiles (profile_url, name, photo_url)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(profile_url) DO NOTHING
+                    RETURNING profile_url
+                ''', (profile['url'], profile['name'], profile['photo'])) as cursor:
+                    if await cursor.fetchone() is not None:
+                        new_profiles.append(profile)
             
-            conn.commit()
-            is_new = cursor.rowcount > 0
-            return is_new
+            await self.db.execute("COMMIT")
+            return new_profiles
             
         except Exception as e:
-            logger.error(f"Ошибка при сохранении профиля: {e}")
-            return False
-        finally:
-            conn.close()
+            if self.db.in_transaction:
+                await self.db.execute("ROLLBACK")
+            logger.error(f"Ошибка при сохранении профилей: {e}")
+            return None
     
-    def get_new_profiles(self):
+    async def get_new_profiles(self):
         """Проверяет наличие новых профилей"""
-        current_profiles = self.extract_profiles()
+        # Загрузка и разбор страницы блокируют, поэтому выполняются в отдельном потоке
+        current_profiles, validators = await asyncio.to_thread(self.extract_profiles)
+        unseen_profiles = [p for p in current_profiles if p['url'] not in self.seen_urls]
         new_profiles = []
+        if unseen_profiles:
+            new_profiles = await self.save_profiles(unseen_profiles)
+            if new_profiles is None:
+                # Не запоминаем валидаторы, чтобы следующая проверка снова получила страницу целиком
+                return []
+            self.seen_urls.update(p['url'] for p in new_profiles)
         
-        for profile in current_profiles:
-            if self.save_profile(profile):
-                new_profiles.append(profile)
-        
+        if validators is not None:
+            self.last_etag, self.last_modified = validators
         return new_profiles
 
-async def send_notification(bot, new_profiles):
-    """Отправляет уведомления о новых профилях"""
-    for profile in new_profiles:
-        try:
-            message = f"🎭 Новый профиль актера:\n\n👤 Имя: {profile['name']}\n🔗 Ссылка: {profile['url']}"
-            
-            if profile['photo']:
+def photo_is_available(session, photo_url):
+    """Проверяет HEAD-запросом, что Telegram сможет загрузить фото по ссылке"""
+    try:
+        response = session.head(photo_url, timeout=PHOTO_CHECK_TIMEOUT, allow_redirects=True)
+    except requests.RequestException as e:
+        logger.warning(f"Фото недоступно {photo_url}: {e}")
+        return False
+    
+    content_length = response.headers.get('Content-Length', '')
+    if response.status_code != 200 or (content_length.isdigit() and int(content_length) > MAX_PHOTO_SIZE):
+        logger.warning(f"Фото не подходит для отправки {photo_url}: код {response.status_code}, размер {content_length}")
+        return False
+    return True
+
+def format_notification(profile):
+    """Формирует текст уведомления о профиле"""
+    return f"🎭 Новый профиль актера:\n\n👤 Имя: {profile['name']}\n🔗 Ссылка: {profile['url']}"
+
+async def send_text_notification(bot, semaphore, profile, text):
+    """Отправляет текстовое уведомление о профиле"""
+    try:
+        async with semaphore:
+            await bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=text)
+        logger.info(f"Отправлено уведомление о профиле: {profile['name']}")
+    except Exception as e:
+        logger.error(f"Не удалось отправить текстовое уведомление: {e}")
+
+async def send_photo_notifications(bot, semaphore, profiles):
+    """Отправляет до MEDIA_GROUP_SIZE профилей с фото одним альбомом"""
+    try:
+        async with semaphore:
+            if len(profiles) == 1:
                 await bot.send_photo(
                     chat_id=TELEGRAM_CHAT_ID,
-                    photo=profile['photo'],
-                    caption=message
+                    photo=profiles[0]['photo'],
+                    caption=format_notification(profiles[0])
                 )
             else:
-                await bot.send_message(
+                await bot.send_media_group(
                     chat_id=TELEGRAM_CHAT_ID,
-                    text=message
+                    media=[
+                        InputMediaPhoto(media=profile['photo'], caption=format_notification(profile))
+                        for profile in profiles
+                    ]
                 )
-            
+        for profile in profiles:
             logger.info(f"Отправлено уведомление о профиле: {profile['name']}")
-            
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления: {e}")
-            # Пытаемся отправить без фото
-            try:
-                await bot.send_message(
-                    chat_id=TELEGRAM_CHAT_ID,
-                    text=f"🎭 Новый профиль (ошибка загрузки фото):\n👤 {profile['name']}\n🔗 {profile['url']}"
-                )
-            except Exception as e2:
-                logger.error(f"Не удалось отправить даже текстовое уведомление: {e2}")
+        
+    except Exception as e:
+        logger.error(f"Ошибка при отправке уведомления: {e}")
+        # Пытаемся отправить без фото
+        await asyncio.gather(*(
+            send_text_notification(
+                bot, semaphore, profile,
+                f"🎭 Новый профиль (ошибка загрузки фото):\n👤 {profile['name']}\n🔗 {profile['url']}"
+            )
+            for profile in profiles
+        ))
+
+async def send_notification(bot, session, new_profiles):
+    """Отправляет уведомления о новых профилях"""
+    semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+    candidates = [profile for profile in new_profiles if profile['photo']]
+    # Заранее отсеиваем битые и слишком большие фото, чтобы не ждать ошибки от Telegram.
+    # Одновременно проверяем не больше HTTP_POOL_SIZE фото, чтобы не переполнять пул соединений
+    check_semaphore = asyncio.Semaphore(HTTP_POOL_SIZE)
+    
+    async def check_photo(profile):
+        async with check_semaphore:
+            return await asyncio.to_thread(photo_is_available, session, profile['photo'])
+    
+    available = await asyncio.gather(*(check_photo(profile) for profile in candidates))
+    with_photo = [profile for profile, ok in zip(candidates, available) if ok]
+    text_only = [profile for profile in new_profiles if not profile['photo']]
+    text_only += [profile for profile, ok in zip(candidates, available) if not ok]
+    
+    tasks = [
+        send_photo_notifications(bot, semaphore, with_photo[i:i + MEDIA_GROUP_SIZE])
+        for i in range(0, len(with_photo), MEDIA_GROUP_SIZE)
+    ]
+    tasks += [
+        send_text_notification(bot, semaphore, profile, format_notification(profile))
+        for profile in text_only
+    ]
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 async def ping_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /ping для проверки работы бота"""
     check_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    monitor = context.bot_data['monitor']
+    count = monitor.profile_count
     
     # Проверяем подключение к базе данных
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM tracked_profiles")
-        count = cursor.fetchone()[0]
-        conn.close()
+        await monitor.check_database()
         db_status = "✅ Работает"
     except Exception as e:
         db_status = f"❌ Ошибка: {e}"
     
     # Проверяем доступность целевой страницы
     try:
-        response = requests.get(URL_TO_MONITOR, timeout=10)
+        response = await asyncio.to_thread(monitor.session.get, URL_TO_MONITOR, timeout=REQUEST_TIMEOUT)
         page_status = "✅ Доступна" if response.status_code == 200 else f"❌ Код: {response.status_code}"
     except Exception as e:
         page_status = f"❌ Ошибка: {e}"
@@ -214,16 +390,30 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def monitor_task(context: ContextTypes.DEFAULT_TYPE):
     """Фоновая задача для мониторинга"""
     bot = context.bot
-    monitor = ProfileMonitor()
+    monitor = context.bot_data['monitor']
+    lock = context.bot_data['monitor_lock']
     
-    logger.info("Запуск проверки новых профилей...")
-    new_profiles = monitor.get_new_profiles()
+    if lock.locked():
+        logger.info("Предыдущая проверка еще не завершилась, пропускаем")
+        return
     
-    if new_profiles:
-        logger.info(f"Найдено новых профилей: {len(new_profiles)}")
-        await send_notification(bot, new_profiles)
-    else:
-        logger.info("Новых профилей не найдено")
+    async with lock:
+        logger.info("Запуск проверки новых профилей...")
+        new_profiles = await monitor.get_new_profiles()
+        
+        if new_profiles:
+            logger.info(f"Найдено новых профилей: {len(new_profiles)}")
+            await send_notification(bot, monitor.session, new_profiles)
+        else:
+            logger.info("Новых профилей не найдено")
+
+async def post_init(application: Application):
+    """Открывает базу данных монитора перед запуском бота"""
+    await application.bot_data['monitor'].init_database()
+
+async def post_shutdown(application: Application):
+    """Освобождает ресурсы монитора после остановки бота"""
+    await application.bot_data['monitor'].close()
 
 def main():
     """Основная функция запуска бота"""
@@ -233,7 +423,19 @@ def main():
         return
     
     # Создаем приложение
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        # Соблюдает лимиты Telegram (~30 сообщений/с всего, 20/мин в группу) и повторяет запрос после RetryAfter
+        .rate_limiter(AIORateLimiter(max_retries=SEND_MAX_RETRIES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    # Один монитор на все время работы: HTTP-сессия, соединение с базой и кэш ссылок живут между проверками
+    application.bot_data['monitor'] = ProfileMonitor()
+    # Не даем проверкам накладываться, если сайт отвечает дольше интервала
+    application.bot_data['monitor_lock'] = asyncio.Lock()
     
     # Добавляем обработчики команд
     application.add_handler(CommandHandler("start", start_command))